@@ -1,27 +1,33 @@
 """
 Video Streaming Platform - Flask Backend
 Admin-controlled uploads, rank-based video access.
-Storage: Excel (users.xlsx, videos.xlsx), videos in /videos
+Storage: SQLite (db.sqlite), videos in /videos
 """
 
+import multiprocessing
 import os
+import re
 import shutil
+import sqlite3
+import subprocess
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import wraps
 from pathlib import Path
 
-import cv2
-import pandas as pd
 from flask import (
     Flask,
     abort,
     flash,
+    g,
     jsonify,
+    make_response,
     redirect,
     render_template,
     request,
     send_file,
-    send_from_directory,
     session,
     url_for,
 )
@@ -32,81 +38,211 @@ from werkzeug.utils import secure_filename
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-change-in-production")
 VIDEOS_DIR = Path(__file__).resolve().parent / "videos"
-USERS_FILE = Path(__file__).resolve().parent / "users.xlsx"
-VIDEOS_META_FILE = Path(__file__).resolve().parent / "videos.xlsx"
+DB_FILE = Path(__file__).resolve().parent / "db.sqlite"
 ALLOWED_VIDEO_EXT = {"mp4", "webm", "mkv", "mov"}
 ALLOWED_IMAGE_EXT = {"jpg", "jpeg", "png", "gif", "webp"}
-RANKS = ["top", "middle", "free"]
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+THUMB_MAX_WIDTH = 640
+THUMB_MAX_AGE = 365 * 24 * 3600
+# Internal nginx location mapped to VIDEOS_DIR (e.g. "/_internal_videos"). When set,
+# stream_video only authorizes and nginx sends the bytes; unset, Flask streams them.
+VIDEO_ACCEL_REDIRECT = os.environ.get("VIDEO_ACCEL_REDIRECT", "").rstrip("/")
+# Hierarchy: a user can watch videos whose tier is <= their own
+RANK_TIERS = {"top": 3, "middle": 2, "free": 1}
+RANKS = frozenset(RANK_TIERS)
 
 # Ensure directories exist
 VIDEOS_DIR.mkdir(exist_ok=True)
 for r in RANKS:
     (VIDEOS_DIR / r).mkdir(exist_ok=True)
+# Resolved once; served names are checked by pattern or DB lookup instead of resolve()
+RANK_DIRS = {r: (VIDEOS_DIR / r).resolve() for r in RANKS}
+# Stored video and thumbnail names: secure_filename()'s alphabet, no leading dot
+SAFE_FILENAME_RE = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9._-]{0,199}")
+
+
+# --- Database helpers ---
+# Numeric tier derived from rank (unknown ranks count as free), indexed for
+# "tier <= user's tier" filtering. Virtual, so writers never have to set it.
+TIER_EXPR = (
+    "CASE rank "
+    + " ".join(f"WHEN '{r}' THEN {t}" for r, t in RANK_TIERS.items())
+    + " ELSE 1 END"
+)
 
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    rank TEXT NOT NULL DEFAULT 'free'
+);
+CREATE TABLE IF NOT EXISTS videos (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    filename TEXT,
+    rank TEXT NOT NULL DEFAULT 'free',
+    description TEXT,
+    thumbnail TEXT,
+    tier INTEGER GENERATED ALWAYS AS ({TIER_EXPR}) VIRTUAL
+);
+CREATE INDEX IF NOT EXISTS idx_videos_rank_filename ON videos(rank, filename);
+CREATE INDEX IF NOT EXISTS idx_videos_rank_thumbnail ON videos(rank, thumbnail);
+-- Serves both "tier <= ?" filters and the admin list order (rank, then title)
+CREATE INDEX IF NOT EXISTS idx_videos_tier_title ON videos(tier DESC, title COLLATE NOCASE);
+"""
 
-# --- Excel helpers ---
-def ensure_users_file():
-    """Create users.xlsx with admin if missing."""
-    if not USERS_FILE.exists():
-        df = pd.DataFrame(
-            [
-                {
-                    "username": "admin",
-                    "password": generate_password_hash("@admin"),
-                    "rank": "top",
-                }
-            ]
-        )
-        df.to_excel(USERS_FILE, index=False)
-    return USERS_FILE
+# Video cards (home grid, /api/videos), shaped in SQL so rows go straight to the template/JSON
+VIDEO_CARD_SELECT = (
+    "SELECT id, coalesce(nullif(title, ''), 'Untitled') AS title, filename, rank,"
+    " substr(trim(coalesce(description, '')), 1, 100) AS description,"
+    " trim(coalesce(thumbnail, '')) AS thumbnail"
+    " FROM videos"
+)
 
 
-def ensure_videos_file():
-    """Create videos.xlsx with headers if missing."""
-    if not VIDEOS_META_FILE.exists():
-        df = pd.DataFrame(
-            columns=["id", "title", "filename", "rank", "description", "thumbnail"]
-        )
-        df.to_excel(VIDEOS_META_FILE, index=False)
-    return VIDEOS_META_FILE
+def connect_db():
+    """Open a new connection to db.sqlite (rows behave like dicts)."""
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    # SQLite's lower()/LIKE only fold ASCII; search lowers q with str.lower()
+    conn.create_function("py_lower", 1, lambda s: (s or "").lower(), deterministic=True)
+    # WAL commits only fsync at checkpoints; still durable against app crashes
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def init_db():
+    """Create tables if missing and seed the default admin."""
+    conn = connect_db()
+    try:
+        # Write-ahead log: commits append to db.sqlite-wal instead of
+        # rewriting pages in place (the setting is stored in the file)
+        conn.execute("PRAGMA journal_mode = WAL")
+        with conn:
+            conn.executescript(SCHEMA)
+            if conn.execute("SELECT 1 FROM users WHERE username = 'admin'").fetchone() is None:
+                # OR IGNORE: every gunicorn worker runs this at startup, concurrently
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (username, password, rank) VALUES (?, ?, ?)",
+                    ("admin", generate_password_hash("@admin"), "top"),
+                )
+    finally:
+        conn.close()
+
+
+def get_db():
+    """Connection for the current request, closed on teardown."""
+    if "db" not in g:
+        g.db = connect_db()
+    return g.db
+
+
+@app.teardown_appcontext
+def close_db(exc):
+    db = g.pop("db", None)
+    if db is not None:
+        db.close()
+
+
+# In-process LRU of read query results. Entries are tagged with PRAGMA data_version
+# of a watcher connection that never writes: it changes whenever any other
+# connection (this process or another gunicorn worker) commits.
+QUERY_CACHE_SIZE = 128
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+_version_conn = None
+_version_lock = threading.Lock()
+
+
+def _db_version():
+    global _version_conn
+    with _version_lock:
+        if _version_conn is None:
+            _version_conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        return _version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def cached_query(sql, params=()):
+    """Run a read-only query, reusing its rows until db.sqlite changes.
+    Returned dicts are shared between requests: do not mutate them."""
+    key = (sql, tuple(params))
+    # Read before querying, so stored rows are never older than their version
+    version = _db_version()
+    with _query_cache_lock:
+        hit = _query_cache.get(key)
+        if hit is not None and hit[0] == version:
+            _query_cache.move_to_end(key)
+            return hit[1]
+    rows = [dict(r) for r in get_db().execute(sql, params)]
+    with _query_cache_lock:
+        _query_cache[key] = (version, rows)
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return rows
+
+
+# Ensure schema exists (gunicorn imports app:app and never runs __main__)
+init_db()
+
+
+def like_pattern(q):
+    """Substring pattern for LIKE ... ESCAPE '\\' (q matched literally)."""
+    q = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{q}%"
 
 
-def get_users_df():
-    ensure_users_file()
-    return pd.read_excel(USERS_FILE)
+def get_user_by_username(username):
+    row = get_db().execute(
+        "SELECT username, password, rank FROM users WHERE username = ?",
+        (str(username).strip(),),
+    ).fetchone()
+    if row is None:
+        return None
+    return {"username": row["username"], "password": row["password"], "rank": row["rank"]}
 
 
-def save_users_df(df):
-    df.to_excel(USERS_FILE, index=False)
+# Password hashing is deliberately slow; bulk imports of at least this many users
+# spread it over CPU cores
+BULK_HASH_MIN = 4
 
 
-def get_videos_df():
-    ensure_videos_file()
-    return pd.read_excel(VIDEOS_META_FILE)
+def hash_passwords(passwords):
+    """generate_password_hash for many passwords, in parallel processes when worthwhile."""
+    if len(passwords) < BULK_HASH_MIN:
+        return [generate_password_hash(p) for p in passwords]
+    workers = min(len(passwords), os.cpu_count() or 1)
+    # Never fork the (threaded) web worker: start children from a clean forkserver
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        return list(pool.map(generate_password_hash, passwords))
 
 
-def save_videos_df(df):
-    df.to_excel(VIDEOS_META_FILE, index=False)
+def normalize(value):
+    """Trimmed, lower-cased form of a request value ("" for None)."""
+    return (value or "").strip().lower()
 
 
-def get_user_by_username(username):
-    df = get_users_df()
-    row = df[df["username"].astype(str).str.strip() == str(username).strip()]
-    if row.empty:
-        return None
-    r = row.iloc[0]
-    return {"username": r["username"], "password": r["password"], "rank": r["rank"]}
+def normalize_rank(value, default="free"):
+    """Normalized rank, or default if it is not one of RANKS."""
+    rank = normalize(value)
+    return rank if rank in RANKS else default
 
 
-def user_can_watch_rank(user_rank, video_rank):
-    """Hierarchy: top > middle > free. User can watch video if user_rank >= video_rank."""
-    order = {"top": 3, "middle": 2, "free": 1}
-    return order.get(user_rank, 0) >= order.get(video_rank, 0)
+def session_tier():
+    """Logged-in user's tier. Hierarchy: top > middle > free; a user can watch
+    a video if session_tier() >= its tier."""
+    tier = session.get("tier")
+    if tier is None:  # Session created before tiers were stored
+        tier = RANK_TIERS.get(session.get("rank", "free"), 0)
+    return tier
 
 
-def safe_str_from_excel(value, default=""):
-    """Safely convert Excel cell value to string, handling NaN/None."""
-    if pd.isna(value) or value is None:
+def safe_str(value, default=""):
+    """Safely convert a DB column value to string, handling NULL/"nan"."""
+    if value is None:
         return default
     s = str(value).strip()
     if s == "" or s.lower() == "nan":
@@ -114,13 +250,60 @@ def safe_str_from_excel(value, default=""):
     return s
 
 
+def probe_duration(video_path):
+    """Container duration in seconds via ffprobe, or None if unknown."""
+    if not FFPROBE:
+        return None
+    try:
+        result = subprocess.run(
+            [FFPROBE, "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", str(video_path)],
+            capture_output=True, text=True, timeout=15, check=True,
+        )
+        duration = float(result.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+    return duration if duration > 0 else None
+
+
 def generate_video_thumbnail(video_path, output_path, frame_position=0.5):
     """
     Extract a frame from the middle (or specified position) of a video and save as thumbnail.
     frame_position: 0.0 to 1.0 (0.5 = middle)
+    Uses the ffmpeg CLI when available, OpenCV otherwise.
     Returns True if successful, False otherwise.
     """
+    if FFMPEG and thumbnail_with_ffmpeg(video_path, output_path, frame_position):
+        return True
+    return thumbnail_with_opencv(video_path, output_path, frame_position)
+
+
+def thumbnail_with_ffmpeg(video_path, output_path, frame_position=0.5):
+    """Single JPEG via input seeking (-ss before -i jumps using the container index)."""
+    duration = probe_duration(video_path)
+    if duration is None:
+        return False
     try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        subprocess.run(
+            [FFMPEG, "-y", "-loglevel", "error",
+             "-ss", f"{duration * frame_position:.3f}", "-i", str(video_path),
+             "-frames:v", "1", "-vf", f"scale='min({THUMB_MAX_WIDTH},iw)':-2",
+             "-q:v", "3", str(output_path)],
+            capture_output=True, timeout=15, check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Thumbnail generation error (ffmpeg): {e}")
+        return False
+    return output_path.is_file() and output_path.stat().st_size > 0
+
+
+def thumbnail_with_opencv(video_path, output_path, frame_position=0.5):
+    """Fallback when ffmpeg is not installed."""
+    try:
+        # Imported here: OpenCV pulls ~80 MB of shared libraries into every worker
+        import cv2
+
         cap = cv2.VideoCapture(str(video_path))
         if not cap.isOpened():
             return False
@@ -133,32 +316,163 @@ def generate_video_thumbnail(video_path, output_path, frame_position=0.5):
         
         # Calculate frame to extract (middle by default)
         target_frame = int(total_frames * frame_position)
-        cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
-        
-        ret, frame = cap.read()
+        frame = read_frame_at(cv2, cap, target_frame)
         cap.release()
         
-        if not ret or frame is None:
+        if frame is None:
             return False
         
-        # Resize to reasonable thumbnail size (max 640px width, maintain aspect ratio)
-        height, width = frame.shape[:2]
-        max_width = 640
-        if width > max_width:
-            scale = max_width / width
-            new_width = max_width
-            new_height = int(height * scale)
-            frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        
-        # Save as JPEG
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(output_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        save_frame_jpeg(cv2, frame, output_path)
         return True
     except Exception as e:
         print(f"Thumbnail generation error: {e}")
         return False
 
 
+def read_frame_at(cv2, cap, target_frame):
+    """Seek an open VideoCapture to target_frame and return that frame (None on failure)."""
+    cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+    # grab() decodes the frame, retrieve() converts it to BGR (together: read())
+    ret, frame = cap.retrieve() if cap.grab() else (False, None)
+    if not ret or frame is None:
+        # Frame-index seeking is unreliable for some codecs; retry with a time-based seek
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if fps > 0:
+            cap.set(cv2.CAP_PROP_POS_MSEC, target_frame / fps * 1000)
+            ret, frame = cap.retrieve() if cap.grab() else (False, None)
+    return frame if ret else None
+
+
+def save_frame_jpeg(cv2, frame, output_path):
+    """Resize an OpenCV frame to thumbnail size (max 640px width, aspect kept) and save as JPEG."""
+    height, width = frame.shape[:2]
+    max_width = THUMB_MAX_WIDTH
+    if width > max_width:
+        scale = max_width / width
+        new_width = max_width
+        new_height = int(height * scale)
+        frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    cv2.imwrite(str(output_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+
+def generate_video_thumbnails(video_path, out_dir, n=5):
+    """
+    Extract n frames (hover previews, sprite sheets): the middle of each of n equal
+    segments of the video, with ffmpeg or OpenCV picking the same sample points.
+    Writes <random hex>_001.jpg ... into out_dir and returns their paths ([] on failure).
+    """
+    prefix = uuid.uuid4().hex
+    out_dir.mkdir(parents=True, exist_ok=True)
+    duration = probe_duration(video_path) if FFMPEG else None
+    if duration is not None:
+        # One ffmpeg process; each sample is its own input-seeked (-ss before -i)
+        # input, so it decodes only from the nearest keyframe to its timestamp
+        inputs, outputs = [], []
+        for i in range(n):
+            inputs += ["-ss", f"{duration * (i + 0.5) / n:.3f}", "-i", str(video_path)]
+            outputs += ["-map", f"{i}:v:0", "-frames:v", "1",
+                        "-vf", f"scale='min({THUMB_MAX_WIDTH},iw)':-2", "-q:v", "3",
+                        str(out_dir / f"{prefix}_{i + 1:03d}.jpg")]
+        try:
+            subprocess.run(
+                [FFMPEG, "-y", "-loglevel", "error", *inputs, *outputs],
+                capture_output=True, timeout=120, check=True,
+            )
+            return sorted(out_dir.glob(f"{prefix}_*.jpg"))
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Thumbnail generation error (ffmpeg): {e}")
+    return thumbnails_with_opencv(video_path, out_dir, prefix, n)
+
+
+def thumbnails_with_opencv(video_path, out_dir, prefix, n):
+    """Fallback for generate_video_thumbnails: one capture, seeking to each sample."""
+    paths = []
+    try:
+        import cv2
+
+        cap = cv2.VideoCapture(str(video_path))
+        if not cap.isOpened():
+            return paths
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        for i in range(n if total_frames > 0 else 0):
+            # Sample the middle of each of n equal segments
+            frame = read_frame_at(cv2, cap, int(total_frames * (i + 0.5) / n))
+            if frame is None:
+                break
+            path = out_dir / f"{prefix}_{i + 1:03d}.jpg"
+            save_frame_jpeg(cv2, frame, path)
+            paths.append(path)
+        cap.release()
+    except Exception as e:
+        print(f"Thumbnail generation error: {e}")
+    return paths
+
+
+UPLOAD_COPY_BUFSIZE = 4 * 1024 * 1024
+
+
+def write_upload_chunk(file_storage, dst_path, offset):
+    """
+    Write an uploaded chunk into dst_path (created if missing) at offset.
+    Werkzeug spools uploads to a temp file, so the bytes are moved with
+    os.sendfile (kernel-side copy); otherwise a copy loop with 4 MiB buffers.
+    """
+    src = file_storage.stream
+    with open(dst_path, "r+b" if dst_path.exists() else "wb") as dst:
+        dst.seek(offset)
+        sent = 0
+        try:
+            in_fd = src.fileno()
+            start = src.tell()
+            size = os.fstat(in_fd).st_size - start
+            while sent < size:
+                n = os.sendfile(dst.fileno(), in_fd, start + sent, size - sent)
+                if n == 0:
+                    break  # Short copy: the rest goes through copyfileobj below
+                sent += n
+            if sent == size:
+                return
+        except (AttributeError, OSError, ValueError):
+            pass  # In-memory stream, or sendfile unsupported for this fd pair (non-Linux)
+        if sent:
+            src.seek(start + sent)
+            dst.seek(offset + sent)
+        shutil.copyfileobj(src, dst, UPLOAD_COPY_BUFSIZE)
+
+
+# Thumbnails are rendered in the background so uploads return as soon as the file is saved
+thumb_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumb")
+
+
+def attach_video_thumbnail(video_id, video_path, thumb_path):
+    """Background job: generate the thumbnail and store it on the video row."""
+    try:
+        if not generate_video_thumbnail(video_path, thumb_path):
+            return  # No thumbnail if generation failed
+        conn = connect_db()
+        try:
+            with conn:
+                # Write lock before reading rank, so admin_edit_video cannot move
+                # the video between this read and the UPDATE below
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT rank FROM videos WHERE id = ?", (video_id,)).fetchone()
+                if row is None:  # Deleted in the meantime
+                    thumb_path.unlink(missing_ok=True)
+                    return
+                # Rank may have been edited (and the video moved) in the meantime
+                final_path = VIDEOS_DIR / row["rank"] / thumb_path.name
+                if final_path != thumb_path:
+                    shutil.move(str(thumb_path), str(final_path))
+                conn.execute(
+                    "UPDATE videos SET thumbnail = ? WHERE id = ?", (thumb_path.name, video_id)
+                )
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Thumbnail generation error: {e}")
+
+
 def is_admin():
     return session.get("username") == "admin"
 
@@ -209,6 +523,7 @@ def login():
             return render_template("login.html")
         session["username"] = user["username"]
         session["rank"] = user["rank"]
+        session["tier"] = RANK_TIERS.get(user["rank"], 0)
         session.permanent = True
         next_url = request.args.get("next") or url_for("home")
         return redirect(next_url)
@@ -226,57 +541,39 @@ def logout():
 @login_required
 def home():
     rank = session.get("rank", "free")
-    filter_rank = (request.args.get("rank") or "").strip().lower()
-    if filter_rank not in RANKS:
-        filter_rank = None
-    q = (request.args.get("q") or "").strip().lower()
-    df = get_videos_df()
-    if df.empty or "rank" not in df.columns:
-        videos = []
-    else:
-        df = df.dropna(subset=["rank"])
-        videos = []
-        for _, row in df.iterrows():
-            vr = str(row.get("rank", "free")).strip().lower()
-            if vr not in RANKS:
-                vr = "free"
-            if filter_rank and vr != filter_rank:
-                continue
-            if q and q not in str(row.get("title", "") or "").lower():
-                continue
-            videos.append(
-                {
-                    "id": row.get("id"),
-                    "title": row.get("title", "Untitled"),
-                    "filename": row.get("filename"),
-                    "rank": vr,
-                    "description": str(row.get("description", ""))[:100],
-                    "thumbnail": safe_str_from_excel(row.get("thumbnail")),
-                }
-            )
+    filter_rank = normalize_rank(request.args.get("rank"), default=None)
+    q = normalize(request.args.get("q"))
+    sql = VIDEO_CARD_SELECT + " WHERE 1 = 1"
+    params = []
+    if filter_rank:
+        sql += " AND rank = ?"
+        params.append(filter_rank)
+    if q:
+        sql += " AND py_lower(title) LIKE ? ESCAPE '\\'"
+        params.append(like_pattern(q))
+    videos = cached_query(sql, params)
     return render_template("home.html", videos=videos, current_rank=rank)
 
 
 @app.route("/watch/<video_id>")
 @login_required
 def watch(video_id):
-    df = get_videos_df()
-    row = df[df["id"].astype(str) == str(video_id)]
-    if row.empty:
+    rows = cached_query(
+        "SELECT id, title, filename, rank, description, thumbnail, tier FROM videos WHERE id = ?",
+        (str(video_id),),
+    )
+    if not rows:
         abort(404)
-    row = row.iloc[0]
-    video_rank = str(row.get("rank", "free")).strip().lower()
-    if video_rank not in RANKS:
-        video_rank = "free"
-    user_rank = session.get("rank", "free")
-    can_watch = user_can_watch_rank(user_rank, video_rank)
+    row = rows[0]
+    video_rank = row["rank"]
+    can_watch = session_tier() >= row["tier"]
     video = {
-        "id": row.get("id"),
-        "title": row.get("title", "Untitled"),
-        "filename": row.get("filename"),
+        "id": row["id"],
+        "title": row["title"] or "Untitled",
+        "filename": row["filename"],
         "rank": video_rank,
-        "description": row.get("description", ""),
-        "thumbnail": row.get("thumbnail"),
+        "description": safe_str(row["description"]),
+        "thumbnail": safe_str(row["thumbnail"]),
     }
     return render_template("watch.html", video=video, can_watch=can_watch)
 
@@ -285,16 +582,26 @@ def watch(video_id):
 @login_required
 def stream_video(rank, filename):
     """Stream video only if user rank allows. Prevents direct URL bypass."""
-    rank = rank.strip().lower()
+    rank = normalize(rank)
     if rank not in RANKS:
         abort(404)
-    if not user_can_watch_rank(session.get("rank", "free"), rank):
+    if session_tier() < RANK_TIERS[rank]:
         abort(403)
-    folder = VIDEOS_DIR / rank
-    path = folder / secure_filename(filename)
-    if not path.is_file() or not path.resolve().is_relative_to(folder.resolve()):
+    # Only files registered for this rank are served; names were validated on upload
+    if not cached_query(
+        "SELECT 1 FROM videos WHERE rank = ? AND filename = ?", (rank, filename)
+    ):
         abort(404)
-    return send_from_directory(folder, filename, mimetype="video/mp4", as_attachment=False)
+    path = RANK_DIRS[rank] / filename
+    if not path.is_file():
+        abort(404)
+    if VIDEO_ACCEL_REDIRECT:
+        resp = make_response("")
+        resp.headers["X-Accel-Redirect"] = f"{VIDEO_ACCEL_REDIRECT}/{rank}/{path.name}"
+        resp.headers["Content-Type"] = "video/mp4"
+        return resp
+    # conditional: ETag/If-Modified-Since and Range (206) support for seeking
+    return send_file(path, mimetype="video/mp4", as_attachment=False, conditional=True)
 
 
 @app.route("/admin")
@@ -331,10 +638,8 @@ def admin_upload():
             # Save temporary chunk
             tmp_path = VIDEOS_DIR / f"{upload_id}.tmp"
             
-            # Append chunk to temporary file
-            with open(tmp_path, "ab") as f:
-                f.seek(chunk_start)
-                video_chunk.save(f)
+            # Write chunk into temporary file at its offset
+            write_upload_chunk(video_chunk, tmp_path, chunk_start)
 
             if not is_last_chunk:
                 return jsonify({"success": True, "message": "Chunk uploaded."})
@@ -342,46 +647,34 @@ def admin_upload():
             # --- Final Chunk Handling ---
             title = (request.form.get("title") or "").strip() or "Untitled"
             description = (request.form.get("description") or "").strip()
-            rank = (request.form.get("rank") or "free").strip().lower()
-            if rank not in RANKS:
-                rank = "free"
+            rank = normalize_rank(request.form.get("rank"))
 
             # Move .tmp file to real video folder
             safe_name = secure_filename(video_chunk.filename)
-            if not safe_name:
-                safe_name = f"{uuid.uuid4().hex}.{ext}"
-            elif "." not in safe_name:
+            if safe_name and "." not in safe_name:
                 safe_name = f"{safe_name}.{ext}"
+            # stream_video trusts stored filenames, so only safe ones are persisted
+            if not SAFE_FILENAME_RE.fullmatch(safe_name):
+                safe_name = f"{uuid.uuid4().hex}.{ext}"
             
             video_path = VIDEOS_DIR / rank / safe_name
             # Ensure directory exists
             video_path.parent.mkdir(parents=True, exist_ok=True)
             shutil.move(str(tmp_path), str(video_path))
 
-            # Generate thumbnail from middle of video
-            thumb_name = f"{uuid.uuid4().hex}.jpg"
-            thumb_path = VIDEOS_DIR / rank / thumb_name
-            thumbnail_generated = generate_video_thumbnail(video_path, thumb_path)
-            if not thumbnail_generated:
-                thumb_name = ""  # No thumbnail if generation failed
-
-            # Metadata
-            df = get_videos_df()
+            # Metadata (thumbnail is filled in by the background job)
             new_id = str(uuid.uuid4())
-            new_row = pd.DataFrame(
-                [
-                    {
-                        "id": new_id,
-                        "title": title,
-                        "filename": safe_name,
-                        "rank": rank,
-                        "description": description,
-                        "thumbnail": thumb_name,
-                    }
-                ]
-            )
-            df = pd.concat([df, new_row], ignore_index=True)
-            save_videos_df(df)
+            db = get_db()
+            with db:
+                db.execute(
+                    "INSERT INTO videos (id, title, filename, rank, description, thumbnail)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (new_id, title, safe_name, rank, description, ""),
+                )
+
+            # Generate thumbnail from middle of video, off the request thread
+            thumb_path = VIDEOS_DIR / rank / f"{uuid.uuid4().hex}.jpg"
+            thumb_pool.submit(attach_video_thumbnail, new_id, video_path, thumb_path)
             
             if request.is_json or request.content_type and "application/json" in request.content_type:
                 return jsonify({"success": True, "message": "Video uploaded successfully."})
@@ -413,44 +706,73 @@ def admin_users():
         if action == "add":
             username = (request.form.get("username") or "").strip()
             password = request.form.get("password") or ""
-            rank = (request.form.get("rank") or "free").strip().lower()
-            if rank not in RANKS:
-                rank = "free"
+            rank = normalize_rank(request.form.get("rank"))
             if not username:
                 flash("Username is required.", "error")
                 return redirect(url_for("admin_users"))
-            df = get_users_df()
-            if username in df["username"].astype(str).values:
+            db = get_db()
+            try:
+                with db:
+                    db.execute(
+                        "INSERT INTO users (username, password, rank) VALUES (?, ?, ?)",
+                        (username, generate_password_hash(password), rank),
+                    )
+            except sqlite3.IntegrityError:
                 flash(f"User '{username}' already exists.", "error")
                 return redirect(url_for("admin_users"))
-            new_row = pd.DataFrame(
-                [
-                    {
-                        "username": username,
-                        "password": generate_password_hash(password),
-                        "rank": rank,
-                    }
-                ]
-            )
-            df = pd.concat([df, new_row], ignore_index=True)
-            save_users_df(df)
             flash(f"User '{username}' added.", "success")
+        elif action == "bulk_add":
+            # One user per line: username,password[,rank]. Passwords are taken
+            # verbatim and may contain commas, but then the rank must be given.
+            entries, skipped = {}, []
+            for line in (request.form.get("users") or "").splitlines():
+                username, _, password = line.partition(",")
+                username = username.strip()
+                if not username:
+                    continue
+                rank = "free"
+                if "," in password:
+                    head, _, last = password.rpartition(",")
+                    rank = normalize(last)
+                    password = head
+                if not password or rank not in RANKS or username in entries:
+                    skipped.append(username)
+                    continue
+                entries[username] = (password, rank)
+            db = get_db()
+            if entries:
+                existing = db.execute(
+                    f"SELECT username FROM users WHERE username IN ({', '.join('?' * len(entries))})",
+                    list(entries),
+                ).fetchall()
+                for r in existing:
+                    skipped.append(r["username"])
+                    del entries[r["username"]]
+            hashes = hash_passwords([password for password, _ in entries.values()])
+            with db:
+                db.executemany(
+                    "INSERT OR IGNORE INTO users (username, password, rank) VALUES (?, ?, ?)",
+                    [
+                        (username, pw_hash, rank)
+                        for (username, (_, rank)), pw_hash in zip(entries.items(), hashes)
+                    ],
+                )
+            flash(f"{len(entries)} user(s) added.", "success")
+            if skipped:
+                flash(f"Skipped (invalid or already exists): {', '.join(skipped)}", "warning")
         elif action == "delete":
             username = (request.form.get("username") or "").strip()
             if username == "admin":
                 flash("Cannot delete admin user.", "error")
                 return redirect(url_for("admin_users"))
-            df = get_users_df()
-            df = df[df["username"].astype(str) != username]
-            save_users_df(df)
+            db = get_db()
+            with db:
+                db.execute("DELETE FROM users WHERE username = ?", (username,))
             flash(f"User '{username}' deleted.", "success")
         return redirect(url_for("admin_users"))
 
-    df = get_users_df()
-    users = [
-        {"username": str(r["username"]), "rank": str(r["rank"])}
-        for _, r in df.iterrows()
-    ]
+    rows = get_db().execute("SELECT username, rank FROM users ORDER BY rowid")
+    users = [{"username": r["username"], "rank": r["rank"]} for r in rows]
     return render_template("admin_users.html", users=users)
 
 
@@ -458,34 +780,33 @@ def admin_users():
 @admin_required
 def admin_edit_user(username):
     """Edit user username and rank. Admin only."""
-    df = get_users_df()
-    row = df[df["username"].astype(str) == str(username)]
-    if row.empty:
+    row = get_user_by_username(username)
+    if row is None:
         abort(404)
-    row = row.iloc[0]
-    user = {"username": str(row["username"]), "rank": str(row["rank"])}
+    user = {"username": row["username"], "rank": row["rank"]}
 
     if request.method == "POST":
         new_username = (request.form.get("username") or "").strip()
-        new_rank = (request.form.get("rank") or "free").strip().lower()
+        new_rank = normalize_rank(request.form.get("rank"))
         new_password = request.form.get("password") or ""
-        if new_rank not in RANKS:
-            new_rank = "free"
         if not new_username:
             flash("Username is required.", "error")
             return redirect(url_for("admin_edit_user", username=username))
-        df = get_users_df()
-        # If username changed, check new one is not taken (by another user)
-        if new_username != user["username"]:
-            if new_username in df["username"].astype(str).values:
-                flash(f"Username '{new_username}' is already taken.", "error")
-                return redirect(url_for("admin_edit_user", username=username))
-        mask = df["username"].astype(str) == str(username)
-        df.loc[mask, "username"] = new_username
-        df.loc[mask, "rank"] = new_rank
+        fields = {"username": new_username, "rank": new_rank}
         if new_password:
-            df.loc[mask, "password"] = generate_password_hash(new_password)
-        save_users_df(df)
+            fields["password"] = generate_password_hash(new_password)
+        assignments = ", ".join(f"{col} = ?" for col in fields)
+        db = get_db()
+        try:
+            with db:
+                db.execute(
+                    f"UPDATE users SET {assignments} WHERE username = ?",
+                    (*fields.values(), user["username"]),
+                )
+        except sqlite3.IntegrityError:
+            # Primary key: the new username belongs to another user
+            flash(f"Username '{new_username}' is already taken.", "error")
+            return redirect(url_for("admin_edit_user", username=username))
         flash(f"User updated.", "success")
         return redirect(url_for("admin_users"))
 
@@ -495,26 +816,12 @@ def admin_edit_user(username):
 @app.route("/admin/videos")
 @admin_required
 def admin_videos():
-    """List all videos for admin (Edit Videos panel)."""
-    df = get_videos_df()
-    if df.empty or "id" not in df.columns:
-        videos = []
-    else:
-        videos = []
-        for _, row in df.iterrows():
-            vid = row.get("id")
-            if pd.isna(vid):
-                continue
-            vr = str(row.get("rank", "free")).strip().lower()
-            if vr not in RANKS:
-                vr = "free"
-            videos.append({
-                "id": str(vid),
-                "title": row.get("title", "Untitled"),
-                "filename": row.get("filename"),
-                "rank": vr,
-                "description": str(row.get("description", "")),
-            })
+    """List all videos for admin (Edit Videos panel), top rank first, then by title."""
+    videos = cached_query(
+        "SELECT id, coalesce(nullif(title, ''), 'Untitled') AS title, filename, rank,"
+        " trim(coalesce(description, '')) AS description"
+        " FROM videos ORDER BY videos.tier DESC, videos.title COLLATE NOCASE"
+    )
     return render_template("admin_videos.html", videos=videos)
 
 
@@ -522,35 +829,42 @@ def admin_videos():
 @admin_required
 def admin_edit_video(video_id):
     """Edit video title, description, and rank (admin only)."""
-    df = get_videos_df()
-    row = df[df["id"].astype(str) == str(video_id)]
-    if row.empty:
+    row = get_db().execute(
+        "SELECT id, title, filename, rank, description, thumbnail FROM videos WHERE id = ?",
+        (str(video_id),),
+    ).fetchone()
+    if row is None:
         abort(404)
-    row = row.iloc[0]
-    old_rank = str(row.get("rank", "free")).strip().lower()
-    if old_rank not in RANKS:
-        old_rank = "free"
+    old_rank = row["rank"]
     video = {
-        "id": str(row.get("id")),
-        "title": row.get("title", "Untitled"),
-        "filename": row.get("filename"),
+        "id": row["id"],
+        "title": row["title"] or "Untitled",
+        "filename": row["filename"],
         "rank": old_rank,
-        "description": str(row.get("description", "")),
+        "description": safe_str(row["description"]),
     }
 
     if request.method == "POST":
         title = (request.form.get("title") or "").strip() or "Untitled"
         description = (request.form.get("description") or "").strip()
-        new_rank = (request.form.get("rank") or "free").strip().lower()
-        if new_rank not in RANKS:
-            new_rank = "free"
-
-        # If rank changed, move video file and thumbnail to new rank folder
-        filename = video["filename"]
-        thumbnail = safe_str_from_excel(row.get("thumbnail"))
-        
-        if filename and not pd.isna(filename):
-            filename = str(filename).strip()
+        new_rank = normalize_rank(request.form.get("rank"))
+
+        db = get_db()
+        with db:
+            # Re-read under the write lock: the background thumbnail job may
+            # have attached (and placed) the thumbnail since the row was loaded
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT rank, thumbnail FROM videos WHERE id = ?", (video["id"],)
+            ).fetchone()
+            if row is None:
+                abort(404)
+            old_rank = row["rank"]
+
+            # If rank changed, move video file and thumbnail to new rank folder
+            filename = safe_str(video["filename"])
+            thumbnail = safe_str(row["thumbnail"])
+            
             if filename:
                 old_path = VIDEOS_DIR / old_rank / filename
                 new_path = VIDEOS_DIR / new_rank / filename
@@ -558,23 +872,21 @@ def admin_edit_video(video_id):
                     new_path.parent.mkdir(parents=True, exist_ok=True)
                     if old_path.resolve() != new_path.resolve():
                         shutil.move(str(old_path), str(new_path))
-        
-        # Move thumbnail if it exists
-        if thumbnail:
-            old_thumb_path = VIDEOS_DIR / old_rank / thumbnail
-            new_thumb_path = VIDEOS_DIR / new_rank / thumbnail
-            if old_thumb_path.is_file():
-                new_thumb_path.parent.mkdir(parents=True, exist_ok=True)
-                if old_thumb_path.resolve() != new_thumb_path.resolve():
-                    shutil.move(str(old_thumb_path), str(new_thumb_path))
-
-        # Update metadata
-        df = get_videos_df()
-        mask = df["id"].astype(str) == str(video_id)
-        df.loc[mask, "title"] = title
-        df.loc[mask, "description"] = description
-        df.loc[mask, "rank"] = new_rank
-        save_videos_df(df)
+            
+            # Move thumbnail if it exists
+            if thumbnail:
+                old_thumb_path = VIDEOS_DIR / old_rank / thumbnail
+                new_thumb_path = VIDEOS_DIR / new_rank / thumbnail
+                if old_thumb_path.is_file():
+                    new_thumb_path.parent.mkdir(parents=True, exist_ok=True)
+                    if old_thumb_path.resolve() != new_thumb_path.resolve():
+                        shutil.move(str(old_thumb_path), str(new_thumb_path))
+
+            # Update metadata
+            db.execute(
+                "UPDATE videos SET title = ?, description = ?, rank = ? WHERE id = ?",
+                (title, description, new_rank, video["id"]),
+            )
         flash("Video updated.", "success")
         return redirect(url_for("admin_videos"))
 
@@ -585,33 +897,35 @@ def admin_edit_video(video_id):
 @admin_required
 def admin_delete_video(video_id):
     """Delete a video (metadata + file). Admin only."""
-    df = get_videos_df()
-    row = df[df["id"].astype(str) == str(video_id)]
-    if row.empty:
-        abort(404)
-    row = row.iloc[0]
-    rank = str(row.get("rank", "free")).strip().lower()
-    if rank not in RANKS:
-        rank = "free"
-    filename = safe_str_from_excel(row.get("filename"))
-    thumbnail = safe_str_from_excel(row.get("thumbnail"))
-    
-    if filename:
+    db = get_db()
+    with db:
+        # Write lock before reading: the background thumbnail job cannot attach
+        # a JPEG between this read and the DELETE (it would be left orphaned)
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT id, filename, rank, thumbnail FROM videos WHERE id = ?", (str(video_id),)
+        ).fetchone()
+        if row is None:
+            abort(404)
+        rank = row["rank"]
+        filename = safe_str(row["filename"])
+        thumbnail = safe_str(row["thumbnail"])
+        
+        if filename:
             path = VIDEOS_DIR / rank / filename
             if path.is_file():
                 try:
                     path.unlink()
                 except OSError:
                     pass
-    if thumbnail:
-        thumb_path = VIDEOS_DIR / rank / thumbnail
-        if thumb_path.is_file():
-            try:
-                thumb_path.unlink()
-            except OSError:
-                pass
-    df = df[df["id"].astype(str) != str(video_id)]
-    save_videos_df(df)
+        if thumbnail:
+            thumb_path = VIDEOS_DIR / rank / thumbnail
+            if thumb_path.is_file():
+                try:
+                    thumb_path.unlink()
+                except OSError:
+                    pass
+        db.execute("DELETE FROM videos WHERE id = ?", (row["id"],))
     flash("Video deleted.", "success")
     return redirect(url_for("admin_videos"))
 
@@ -621,51 +935,38 @@ def admin_delete_video(video_id):
 @login_required
 def thumb(rank, filename):
     """Serve thumbnail images. All logged-in users can see thumbnails (videos are visible on home)."""
-    rank = rank.strip().lower()
+    rank = normalize(rank)
     if rank not in RANKS:
         abort(404)
-    folder = VIDEOS_DIR / rank
-    path = folder / secure_filename(filename)
-    if not path.is_file() or not path.resolve().is_relative_to(folder.resolve()):
+    # Only registered thumbnails: the rank folders also hold the (tier-gated) videos
+    if not cached_query(
+        "SELECT 1 FROM videos WHERE rank = ? AND thumbnail = ?", (rank, filename)
+    ):
+        abort(404)
+    path = RANK_DIRS[rank] / filename
+    if not path.is_file():
         abort(404)
-    return send_from_directory(folder, filename, mimetype="image/jpeg")
+    resp = send_file(path, mimetype="image/jpeg", conditional=True)
+    # Thumbnail names are random and never reused, so browsers can keep them forever.
+    # "private": they sit behind login, shared caches must not store them.
+    resp.headers["Cache-Control"] = f"private, max-age={THUMB_MAX_AGE}, immutable"
+    return resp
 
 
 # API for search (optional)
 @app.route("/api/videos")
 @login_required
 def api_videos():
-    rank = session.get("rank", "free")
-    q = (request.args.get("q") or "").strip().lower()
-    df = get_videos_df()
-    if df.empty:
-        return jsonify([])
-    df = df.dropna(subset=["rank"])
-    out = []
-    for _, row in df.iterrows():
-        vr = str(row.get("rank", "free")).strip().lower()
-        if vr not in RANKS:
-            vr = "free"
-        if not user_can_watch_rank(rank, vr):
-            continue
-        if q and q not in str(row.get("title", "") or "").lower():
-            continue
-        out.append(
-            {
-                "id": row.get("id"),
-                "title": row.get("title", "Untitled"),
-                "filename": row.get("filename"),
-                "rank": vr,
-                "description": str(row.get("description", ""))[:100],
-                "thumbnail": row.get("thumbnail"),
-            }
-        )
-    return jsonify(out)
+    q = normalize(request.args.get("q"))
+    sql = VIDEO_CARD_SELECT + " WHERE tier <= ?"
+    params = [session_tier()]
+    if q:
+        sql += " AND py_lower(title) LIKE ? ESCAPE '\\'"
+        params.append(like_pattern(q))
+    return jsonify(cached_query(sql, params))
 
 
 if __name__ == "__main__":
     # Local development entrypoint. In production (Render), gunicorn runs `app:app`.
-    ensure_users_file()
-    ensure_videos_file()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -1,25 +1,54 @@
 """
-Run once to create users.xlsx (with default admin) and videos.xlsx if they don't exist.
+Run once to import users.xlsx and videos.xlsx into db.sqlite.
+Missing spreadsheets are skipped; the app seeds the default admin on its own.
 Default admin: username=admin, password=@admin, rank=top
 """
 from pathlib import Path
 import pandas as pd
-from werkzeug.security import generate_password_hash
+
+from app import RANKS, connect_db, init_db
 
 BASE = Path(__file__).resolve().parent
 USERS_FILE = BASE / "users.xlsx"
 VIDEOS_FILE = BASE / "videos.xlsx"
 
-if not USERS_FILE.exists():
-    df = pd.DataFrame([
-        {"username": "admin", "password": generate_password_hash("@admin"), "rank": "top"}
-    ])
-    df.to_excel(USERS_FILE, index=False)
-    print("Created users.xlsx with default admin (admin / @admin)")
-
-if not VIDEOS_FILE.exists():
-    df = pd.DataFrame(columns=["id", "title", "filename", "rank", "description", "thumbnail"])
-    df.to_excel(VIDEOS_FILE, index=False)
-    print("Created videos.xlsx")
+USER_COLUMNS = ["username", "password", "rank"]
+VIDEO_COLUMNS = ["id", "title", "filename", "rank", "description", "thumbnail"]
+
+
+def load_sheet(path, columns):
+    """Read a spreadsheet, keep known columns, strip the key and normalize rank."""
+    with pd.ExcelFile(path, engine="calamine") as xls:
+        df = xls.parse(sheet_name=0, dtype=str).reindex(columns=columns)
+    key = columns[0]
+    # The app looks users/videos up by the stripped key; blank keys are dropped
+    df[key] = df[key].str.strip().replace("", None)
+    df["rank"] = df["rank"].fillna("free").str.strip().str.lower()
+    df.loc[~df["rank"].isin(RANKS), "rank"] = "free"
+    return df.dropna(subset=[key])
+
+
+def import_sheet(conn, path, table, columns):
+    df = load_sheet(path, columns)
+    staging = f"{table}_import"
+    df.to_sql(staging, conn, if_exists="replace", index=False)
+    cols = ", ".join(columns)
+    with conn:
+        conn.execute(f"INSERT OR REPLACE INTO {table} ({cols}) SELECT {cols} FROM {staging}")
+        conn.execute(f"DROP TABLE {staging}")
+    return len(df)
+
+
+init_db()
+conn = connect_db()
+try:
+    if USERS_FILE.exists():
+        n = import_sheet(conn, USERS_FILE, "users", USER_COLUMNS)
+        print(f"Imported {n} user(s) from users.xlsx")
+    if VIDEOS_FILE.exists():
+        n = import_sheet(conn, VIDEOS_FILE, "videos", VIDEO_COLUMNS)
+        print(f"Imported {n} video(s) from videos.xlsx")
+finally:
+    conn.close()
 
 print("Done. Run: python app.py")